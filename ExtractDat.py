@@ -1,4 +1,4 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 
 """
 Classes for extracting data from Thermo Element ICP Mass Spectrometer dat files
@@ -22,6 +22,8 @@ License version 2.1 along with this program.
 If not, see <http://www.gnu.org/licenses/>.
 """
 import struct
+import mmap
+import array
 from pprint import *
 import sys
 import os
@@ -29,10 +31,16 @@ import optparse
 import glob
 import datetime
 import math
-from collections import defaultdict
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 VERSION = '2.4'
 
+OUTPUT_BUFFER_SIZE = 1 << 20
+# FIN2 files are read, and CSV files written, as Latin-1 so that element names pass through
+# byte for byte.
+CSV_ENCODING = 'latin-1'
+
 HDR_INDEX_OFFSET = 33
 HDR_INDEX_LEN = 39
 HDR_TIMESTAMP = 40
@@ -47,7 +55,7 @@ SCAN_FCF = 34
 
 def Debug(msg):
     if options.debug:
-        print msg
+        print(msg)
 
 KEY_EOS = 0xF # end of scan/acquisition
 KEY_EOM = 0x8 # end of mass
@@ -62,6 +70,25 @@ DATA_ANALOG = 0x0
 DATA_PULSE = 0x1
 DATA_FARADAY = 0x8
 
+# Measurement types in the order they appear in the CSV output. Masses without Faraday
+# measurements have an empty 'faraday' list so they contribute no columns for it.
+MODES = ('pulse', 'analog', 'faraday')
+
+_U32_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L' # array type code for 32-bit words
+_wordStructs = {}
+
+# The signed scale of a data record's mantissa, indexed by its flag and exponent fields
+# ((value >> 16) & 0xF0F). A non-zero flag means the value is negative.
+_SCALES = [(-1 if i >> 8 else 1) << (i & 0xF) for i in range(0xF10)]
+
+def _UnpackWords(buf, offset, count):
+    """Unpacks up to count 32-bit words from the buffer at the specified offset."""
+    count = max(min(count, (len(buf) - offset) // 4), 1)
+    s = _wordStructs.get(count)
+    if s is None:
+        s = _wordStructs[count] = struct.Struct("<%dI" % count)
+    return s.unpack_from(buf, offset)
+
 class DATException(Exception):
     """Base exception class for this module."""
     pass
@@ -86,137 +113,233 @@ def _CheckOpen(fd):
     if fd is None:
         raise NotOpen()
 
-class Mass(object):
-    """Class for one mass in a scan."""
-    def __init__(self, scan, fd, offset):
-        """Decodes the mass information from the scan at the specified file and offset"""
-        _CheckOpen(fd)
-        self.fd = fd
-        self.offset = offset
-        self.scan = scan
-        self.magnetMass = None
-        self.acceleratingVoltage = None
-        self.channelTime = None
-        self.duration = None
-        self.measurements = defaultdict(list)
-        fd.seek(offset)
-        while True:
-            tmp = struct.unpack("<I", fd.read(4))[0]
-            key = (tmp & 0xF0000000) >> 28
+def _Buckets(analog, pulse, faraday):
+    """Returns the list for each data type, indexed by a data record's 4-bit data type field."""
+    buckets = [None] * 16
+    buckets[DATA_ANALOG] = analog
+    buckets[DATA_PULSE] = pulse
+    buckets[DATA_FARADAY] = faraday
+    return buckets
+
+def _DecodeMass(buf, offset, edac, buckets):
+    """Decodes the records of the mass at the specified buffer and offset.
+
+    The measurements are appended to the lists in buckets (see _Buckets); if buckets is None
+    the data records are skipped without being decoded. Returns (magnetMass,
+    acceleratingVoltage, channelTime, duration, end) where end is the offset just past the
+    mass. Raises EOS if the scan ends instead.
+    """
+    magnetMass = None
+    acceleratingVoltage = None
+    channelTime = None
+    scales = _SCALES
+    # Unpack the words a block at a time, doubling the block size until the
+    # end of the mass is found.
+    count = 32
+    while True:
+        for tmp in _UnpackWords(buf, offset, count):
+            offset += 4
+            key = tmp >> 28
             value = tmp & 0x0FFFFFFF
-            if key == KEY_EOS: # end of scan
+            # Nearly all of the records in a mass are data, so check for them first.
+            if key == KEY_DATA:
+                if buckets is None:
+                    continue
+                bucket = buckets[(value & 0x00F00000) >> 20]
+                if bucket is None:
+                    raise UnknownDataType(str((value & 0x00F00000) >> 20))
+                bucket.append((value & 0x0000FFFF) * scales[value >> 16 & 0xF0F])
+            elif key == KEY_EOS: # end of scan
                 raise EOS()
             elif key == KEY_EOM: # end of mass
-                self._SetAttr('duration', value)
-                self.size = fd.tell() - self.offset
-                break
+                return magnetMass, acceleratingVoltage, channelTime, value, offset
             elif key == KEY_BSCAN:
                 pass # not sure what to do with this
             elif key == KEY_B:
                 pass # not sure what to do with this either
             elif key == KEY_VOLT:
-                value = scan.edac * 1000.0 / value / 2**18 # TODO: verify this formula
-                self.acceleratingVoltage = value  
+                acceleratingVoltage = edac * 1000.0 / value / 2**18 # TODO: verify this formula
             elif key == KEY_TIME:
-                self._SetAttr('channelTime', value)
+                if channelTime is not None:
+                    raise Exception("channelTime is already set")
+                channelTime = value
             elif key == KEY_MASS:
-                self.magnetMass = value * 1.0 / 2**18
-            elif key == KEY_DATA:
-                flag = (value & 0x0F000000) >> 24
-                dataType = (value & 0x00F00000) >> 20
-                exp = (value & 0x000F0000) >> 16
-                value = value & 0x0000FFFF
-                if dataType == DATA_ANALOG:
-                    value = value << exp
-                    if flag != 0:
-                        value = -value
-                    self.measurements['analog'].append(value)
-                elif dataType == DATA_PULSE:
-                    value = value << exp
-                    if flag != 0:
-                        value = -value
-                    self.measurements['pulse'].append(value)
-                elif dataType == DATA_FARADAY:
-                    value = value << exp
-                    if flag != 0:
-                        value = -value
-                    self.measurements['faraday'].append(value)
-                else:
-                    raise UnknownDataType(str(dataType))
+                magnetMass = value * 1.0 / 2**18
             else:
                 raise UnknownKey(str(key))
+        count *= 2
 
-    def _SetAttr(self, name, value):
-        """Sets an attribute if it is no already set."""
-        if getattr(self, name) is not None:
-            raise Exception(name + " is already set")
+class Mass(object):
+    """Class for one mass in a scan.
+
+    measurements maps each type ('analog', 'pulse', 'faraday') to its values. For the masses
+    from iterating a Scan (see Scan.Decode) these are memoryview slices of the scan's arrays;
+    for a Mass created on its own, e.g. by Scan.GetMass, they are array.array('i').
+    """
+    def __init__(self, scan, buf, offset, buckets=None):
+        """Decodes the mass information from the scan at the specified buffer and offset.
+
+        If buckets is given the measurements are appended to its lists instead, and setting
+        self.measurements is up to the caller.
+        """
+        _CheckOpen(buf)
+        self.buf = buf
+        self.offset = offset
+        self.scan = scan
+        if buckets is None:
+            analog = []
+            pulse = []
+            faraday = []
+            (self.magnetMass, self.acceleratingVoltage, self.channelTime, self.duration,
+             end) = _DecodeMass(buf, offset, scan.edac, _Buckets(analog, pulse, faraday))
+            # Measurements fit in a signed 32-bit int (16-bit mantissa shifted by at most 15).
+            self.measurements = {'analog': array.array('i', analog),
+                                 'pulse': array.array('i', pulse),
+                                 'faraday': array.array('i', faraday)}
         else:
-            setattr(self, name, value)
+            (self.magnetMass, self.acceleratingVoltage, self.channelTime, self.duration,
+             end) = _DecodeMass(buf, offset, scan.edac, buckets)
+            self.measurements = None
+        self.size = end - offset
+
+class MassInfo(object):
+    """Class for the information of one mass in a scan, without its measurements.
+
+    The data records are skipped when the mass is decoded; Measurements() decodes them
+    on demand while the dat file is still open.
+    """
+    def __init__(self, scan, buf, offset):
+        """Decodes the mass information from the scan at the specified buffer and offset"""
+        _CheckOpen(buf)
+        self.buf = buf
+        self.offset = offset
+        self.scan = scan
+        (self.magnetMass, self.acceleratingVoltage, self.channelTime, self.duration,
+         end) = _DecodeMass(buf, offset, scan.edac, None)
+        self.size = end - offset
+
+    def Measurements(self):
+        """Decodes and returns the measurements of the mass."""
+        # Use the dat file's current buffer, which is None once the file is closed.
+        buf = self.scan.dat.buf
+        _CheckOpen(buf)
+        return Mass(self.scan, buf, self.offset).measurements
 
 class Scan(object):
-    """Class for one scan in a dat file."""
+    """Class for one scan in a dat file.
+
+    The masses are decoded from the dat file's buffer, so NotOpen is raised once it is closed.
+    """
+    _header = struct.Struct("<47I")
+
     def __init__(self, dat, offset):
         """Decodes the scan information at the specified file and offset."""
-        dat.fd.seek(offset)
-        self.headerSize = 47 * 4
-        vals = struct.unpack("<%dI" % (self.headerSize / 4), dat.fd.read(self.headerSize))
+        self.headerSize = self._header.size
+        vals = self._header.unpack_from(dat.buf, offset)
         self.number = vals[SCAN_NUMBER]
         self.delta = vals[SCAN_DELTA]
         self.acf = vals[SCAN_ACF]
         self.time = vals[SCAN_TIME]
         self.fcf = vals[SCAN_FCF]
         self.edac = vals[SCAN_EDAC]
-        self._vals = vals
         self.fd = dat.fd
         self.offset = offset + self.headerSize # skip over header
         self.dat = dat
+        # Set by Decode.
+        self.analog = None
+        self.pulse = None
+        self.faraday = None
+        self.massOffsets = None
+        self._masses = None
 
     def __iter__(self):
         """Enables iterating over the masses in a scan."""
-        return ScanIterator(self, self.offset)
+        return iter(self.Decode())
+
+    def Decode(self):
+        """Decodes all of the masses in the scan and returns them in a list.
+
+        The measurements of all the masses are stored in the scan's analog, pulse and faraday
+        arrays, and the measurements of each mass are memoryview slices of them, so the
+        arrays must not be resized. massOffsets[i] is the (analog, pulse, faraday) index at
+        which mass i starts; its last entry holds the ends of the arrays.
+        """
+        if self._masses is not None:
+            return self._masses
+        buf = self.dat.buf
+        _CheckOpen(buf)
+        analog = []
+        pulse = []
+        faraday = []
+        buckets = _Buckets(analog, pulse, faraday)
+        masses = []
+        massOffsets = [(0, 0, 0)]
+        offset = self.offset
+        while True:
+            try:
+                mass = Mass(self, buf, offset, buckets)
+            except EOS:
+                break
+            masses.append(mass)
+            massOffsets.append((len(analog), len(pulse), len(faraday)))
+            offset += mass.size
+        self.analog = array.array('i', analog)
+        self.pulse = array.array('i', pulse)
+        self.faraday = array.array('i', faraday)
+        views = (memoryview(self.analog), memoryview(self.pulse), memoryview(self.faraday))
+        for mass, start, end in zip(masses, massOffsets, massOffsets[1:]):
+            mass.measurements = {'analog': views[0][start[0]:end[0]],
+                                 'pulse': views[1][start[1]:end[1]],
+                                 'faraday': views[2][start[2]:end[2]]}
+        self.massOffsets = massOffsets
+        self._masses = masses
+        return masses
+
+    def IterMassInfo(self):
+        """Iterates over the masses in a scan without decoding their measurements."""
+        offset = self.offset
+        while True:
+            # Check the dat file each time in case it is closed between masses.
+            buf = self.dat.buf
+            _CheckOpen(buf)
+            try:
+                info = MassInfo(self, buf, offset)
+            except EOS:
+                return
+            offset += info.size
+            yield info
 
     def GetMass(self, offset):
         """Creates a Mass object from the data at the specified offset."""
-        _CheckOpen(self.fd)
+        buf = self.dat.buf
+        _CheckOpen(buf)
         try:
-            mass = Mass(self, self.fd, offset)
+            mass = Mass(self, buf, offset)
         except EOS:
             mass = None
         return mass
 
-class ScanIterator(object):
-    """Iterates over the masses in a scan."""
-    def __init__(self, scan, offset):
-        _CheckOpen(scan.fd)
-        self._scan = scan
-        self._offset = offset
-
-    def next(self):
-        mass = self._scan.GetMass(self._offset)
-        if mass is None:
-            raise StopIteration
-        else:
-            self._offset += mass.size
-        return mass
-
 class DatFile(object):
     """Class for one dat file."""
+    _header = struct.Struct("<85I")
+
     def __init__(self, path):
         self.path = path
         self.fd = None
+        self.buf = None
         # Read the header.
         with open(self.path, 'rb') as fd:
             fd.seek(0x10)
-            fields = 85
-            tmp = fd.read(fields * 4)
-            vals = struct.unpack('<%dI' % fields, tmp)
+            tmp = fd.read(self._header.size)
+            vals = self._header.unpack(tmp)
             self.timestamp = vals[HDR_TIMESTAMP]
             self._indexLen = vals[HDR_INDEX_LEN]
             self._indexOffset = vals[HDR_INDEX_OFFSET]
             self._vals = vals
             fd.seek(self._indexOffset + 4)
-            bytes = self._indexLen * 4
-            self._offsets = struct.unpack("<%dI" % self._indexLen, fd.read(bytes))
+            self._offsets = array.array(_U32_TYPECODE, fd.read(self._indexLen * 4))
+            if sys.byteorder == 'big':
+                self._offsets.byteswap()
 
     def __iter__(self):
         """Enables iteration over the scans in a dat file."""
@@ -225,9 +348,17 @@ class DatFile(object):
     def Open(self):
         """Opens the dat file."""
         self.fd = open(self.path, 'rb')
+        try:
+            self.buf = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # Can't map the file (e.g. some network drives), read it instead.
+            self.buf = self.fd.read()
 
     def Close(self):
         """Closes the dat file."""
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.buf = None
         self.fd.close()
         self.fd = None
 
@@ -237,7 +368,7 @@ class DatFile(object):
 
     def GetScan(self, index):
         """Creates a Scan object from the data in the index'th scan."""
-        _CheckOpen(self.fd)
+        _CheckOpen(self.buf)
         if index >= len(self._offsets):
             raise IndexError("Scan index out of range: %d >= %d" % (index, len(self._offsets)))
         else:
@@ -249,7 +380,10 @@ class DatFileIterator(object):
         self._dat = dat
         self._i = 0
 
-    def next(self):
+    def __iter__(self):
+        return self
+
+    def __next__(self):
         if self._i >= self._dat.NumScans():
             raise StopIteration
         else:
@@ -257,6 +391,92 @@ class DatFileIterator(object):
             self._i += 1
         return scan
 
+def _Headers(dat, elements):
+    """Returns the CSV column headers for an open dat file.
+
+    The value columns are based on the first scan that can be decoded. Returns None if there
+    is no such scan.
+    """
+    for scan in dat:
+        headers = ["Scan", "Time", "ACF"]
+        valueHeaders = []
+        faraday = False
+        try:
+            for j, mass in enumerate(scan):
+                if len(mass.measurements['faraday']) > 0:
+                    faraday = True
+                element = f"Mass{j+1:02d}" if elements is None else elements[j]
+                for t in MODES:
+                    valueHeaders += [f"{element}{t[0]}"] * len(mass.measurements[t])
+                valueHeaders.append('')
+        except (UnknownDataType, UnknownKey):
+            continue
+        if faraday:
+            headers.append('FCF')
+        return headers + valueHeaders
+    return None
+
+def _WriteCSV(path, outputfile, comments):
+    """Decodes a dat file and writes its contents to a CSV file.
+
+    Returns (outputfile, header) where header is the line number of the column headers in the
+    output file, or None if it has no headers.
+    """
+    dat = DatFile(path)
+    header = None
+    with open(outputfile, "w", OUTPUT_BUFFER_SIZE, encoding=CSV_ENCODING) as output:
+        dat.Open()   # TODO: context
+        # Read elements from FIN2 file if it exists.
+        try:
+            name = os.path.splitext(dat.path)[0] + '.FIN2'
+            with open(name, 'r', encoding=CSV_ENCODING) as fin2:
+                # The elements are on the 8th line.
+                for i in range(0, 8):
+                    line = fin2.readline()
+            elements = line.strip().split(',')[1:] if line else None
+        except OSError:
+            elements = None
+        if comments:
+            print(dat.path, dat.timestamp, datetime.datetime.fromtimestamp(dat.timestamp), file=output)
+        headers = _Headers(dat, elements)
+        if headers is not None:
+            header = 1 if comments else 0
+            output.write(",".join(headers) + "\n")
+
+        for i, scan in enumerate(dat):
+            timestamp = dat.timestamp + scan.time / 1000.0
+            results = [str(i+1), f'{timestamp:f}', f'{scan.acf:f}']
+            values = []
+
+            try:
+                for mass in scan:
+                    measurements = mass.measurements
+                    for t in MODES:
+                        # Negative values are written as their magnitude followed by '*'.
+                        values += [str(-x) + '*' if x < 0 else str(x) for x in measurements[t]]
+                    values.append('')
+                if len(scan.faraday) > 0:
+                    results.append(f'{scan.fcf:f}')
+
+            except UnknownDataType as e:
+                print(f"Warning: unknown data type 0x{int(e.args[0]):x}", file=sys.stderr)
+                continue
+            except UnknownKey as e:
+                print(f"Warning: unknown key 0x{int(e.args[0]):x}", file=sys.stderr)
+                continue
+            output.write(",".join(results + values) + "\n")
+        dat.Close()
+    return outputfile, header
+
+def _AppendCSV(output, path, skip=None):
+    """Appends the contents of a CSV file to output, leaving out line number skip if given."""
+    with open(path, "r", encoding=CSV_ENCODING) as f:
+        if skip is not None:
+            for i in range(0, skip):
+                output.write(f.readline())
+            f.readline()
+        shutil.copyfileobj(f, output, OUTPUT_BUFFER_SIZE)
+
 description = \
 """\
 Decodes the specified dat files and produces a CSV file of their contents. If a single file is
@@ -328,84 +548,61 @@ def main(args):
     if len(dats) > 1:
         # create combined output file name from first dat file name
         base = os.path.splitext(os.path.split(dats[0].path)[1])[0] + 'combined'
+        # List the directory once instead of checking each candidate name.
+        try:
+            with os.scandir(outputdir or os.curdir) as entries:
+                existing = {entry.name for entry in entries if entry.name.startswith(base)}
+        except OSError:
+            existing = set()
         i = 0
-        while True:
-            path = os.path.join(outputdir, base + '%02d' % i + '.csv')
-            if not os.path.exists(path):
-                break
+        while base + '%02d' % i + '.csv' in existing:
             i += 1
+        path = os.path.join(outputdir, base + '%02d' % i + '.csv')
         try:
-            combinedOutput = open(path, "w")
-            print "Writing to", path
-        except:
+            combinedOutput = open(path, "w", OUTPUT_BUFFER_SIZE, encoding=CSV_ENCODING)
+            print("Writing to", path)
+        except OSError:
             combinedOutput = None
 
-    first = True
-    for dat in dats:
-        headers = ["Scan", "Time", "ACF"]
-        outputfile = os.path.splitext(dat.path)[0] + '.csv'
-        with open(outputfile, "w") as output:
-            print "Writing to", outputfile
-            dat.Open()   # TODO: context
-            # Read elements from FIN2 file if it exists.
-            try:
-                name = os.path.splitext(dat.path)[0] + '.FIN2'
-                with open(name, 'rb') as fin2:
-                    for i in xrange(0, 8):
-                        line = fin2.readline().strip()
-                    elements = line.split(',')[1:]
-            except:
-                elements = None
-            if options.comments:
-                print >> output, dat.path, dat.timestamp, datetime.datetime.fromtimestamp(dat.timestamp)
-                if combinedOutput != None:
-                    print >> combinedOutput, dat.path, dat.timestamp, datetime.datetime.fromtimestamp(dat.timestamp)
-
-            for i, scan in enumerate(dat):
-                timestamp = dat.timestamp + scan.time / 1000.0
-                results = [str(i+1), '%f' % timestamp, '%f' % scan.acf]
-                values = []
-                valueHeaders = []
-                faraday = False
-                
-                try:
-                    for j, mass in enumerate(scan):
-                        modes = ['pulse', 'analog']
-                        if len(mass.measurements['faraday']) > 0:
-                            modes.append('faraday')
-                            faraday = True
-                        if headers is not None:
-                            element = "Mass%02d" % (j+1) if elements is None else elements[j]
-                            if headers is not None:
-                                for t in modes:
-                                    valueHeaders += ["%s%s" % (element, t[0])] * len(mass.measurements[t])
-                                valueHeaders.append('')
-                        for t in modes:
-                            values += map(lambda x: str(x) if not str(x).startswith('-') else str(-x)+'*', mass.measurements[t])
-                        values.append('')
-                    if faraday:
-                        if headers is not None:
-                            headers.append('FCF')
-                        results.append('%f' % scan.fcf)
-
-                except UnknownDataType, e:
-                    print >> sys.stderr, "Warning: unknown data type 0x%x" % int(e.message)
-                    continue
-                except UnknownKey, e:
-                    print >> sys.stderr, "Warning: unknown key 0x%x" % int(e.message)
-                    continue
-                if headers is not None:
-                    msg = ",".join(headers + valueHeaders)
-                    print >> output, msg
-                    if combinedOutput != None and first:
-                        print >> combinedOutput, msg
-                    headers = None
-                msg = ",".join(results + values)
-                print >> output, msg
-                if combinedOutput != None:
-                    print >> combinedOutput, msg
-            dat.Close()
+    paths = [dat.path for dat in dats]
+    outputfiles = [os.path.splitext(path)[0] + '.csv' for path in paths]
+    for outputfile in outputfiles:
+        print("Writing to", outputfile)
+    # A file can be given more than once (e.g. a directory and a file in it). Decode each
+    # file only once, so that no two workers write the same output file, but still append it
+    # to the combined output each time it was given.
+    keys = [os.path.normcase(os.path.abspath(outputfile)) for outputfile in outputfiles]
+    jobs = []
+    for i, key in enumerate(keys):
+        if key not in keys[:i]:
+            jobs.append(i)
+    jobPaths = [paths[i] for i in jobs]
+    jobOutputfiles = [outputfiles[i] for i in jobs]
+    comments = [options.comments] * len(jobs)
+    executor = None
+    if len(jobs) > 1:
+        # The dat files are independent so decode them in parallel. map returns the results
+        # in order so the combined output is in the same order as before.
+        executor = ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1))
+        results = executor.map(_WriteCSV, jobPaths, jobOutputfiles, comments)
+    else:
+        results = map(_WriteCSV, jobPaths, jobOutputfiles, comments)
+    try:
+        first = True
+        done = {}
+        for key in keys:
+            if key not in done:
+                done[key] = next(results)
+            outputfile, header = done[key]
+            if combinedOutput != None:
+                # Only the first file's headers go in the combined output.
+                _AppendCSV(combinedOutput, outputfile, None if first else header)
             first = False
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if combinedOutput != None:
+        combinedOutput.close()
 
 if __name__ == '__main__':
     main(sys.argv)
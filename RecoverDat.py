@@ -1,4 +1,4 @@
-#!/usr/bin/env python2.7
+#!/usr/bin/env python3
 
 """
 This is a modified version of ExtractDat that does not use the scan
@@ -27,6 +27,8 @@ License version 2.1 along with this program.
 If not, see <http://www.gnu.org/licenses/>.
 """
 import struct
+import mmap
+import array
 from pprint import *
 import sys
 import os
@@ -34,10 +36,16 @@ import optparse
 import glob
 import datetime
 import math
-from collections import defaultdict
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 VERSION = '2.4'
 
+OUTPUT_BUFFER_SIZE = 1 << 20
+# FIN2 files are read, and CSV files written, as Latin-1 so that element names pass through
+# byte for byte.
+CSV_ENCODING = 'latin-1'
+
 HDR_NUM_FIELDS = 85
 HDR_INDEX_OFFSET = 33
 HDR_INDEX_LEN = 39
@@ -53,7 +61,7 @@ SCAN_FCF = 34
 
 def Debug(msg):
     if options.debug:
-        print msg
+        print(msg)
 
 KEY_EOS = 0xF # end of scan/acquisition
 KEY_EOM = 0x8 # end of mass
@@ -68,6 +76,20 @@ DATA_ANALOG = 0x0
 DATA_PULSE = 0x1
 DATA_FARADAY = 0x8
 
+_READ_SIZE = 1 << 16 # size of the reads done by _BufferedReader
+# Scan headers are identified by these words at this offset.
+_SCAN_SIGNATURE = struct.pack("<3I", 0xd, 0xe, 0xf)
+_SCAN_SIGNATURE_OFFSET = 3 * 4
+_wordStructs = {}
+
+def _UnpackWords(buf, offset, count):
+    """Unpacks up to count 32-bit words from the buffer at the specified offset."""
+    count = max(min(count, (len(buf) - offset) // 4), 1)
+    s = _wordStructs.get(count)
+    if s is None:
+        s = _wordStructs[count] = struct.Struct("<%dI" % count)
+    return s.unpack_from(buf, offset)
+
 class DATException(Exception):
     """Base exception class for this module."""
     pass
@@ -98,93 +120,229 @@ def _CheckOpen(fd):
 
 def _Seek(fd, offset, whence = 0):
     fd.seek(offset, whence)
-    Debug("Offset is now %d" % fd.tell())
+    if options.debug:
+        Debug("Offset is now %d" % fd.tell())
+
+class _BufferedReader(object):
+    """Reads a file through a buffer.
+
+    Supports read, seek, tell and close like a file. The bytes at the cursor are
+    buf[pos:], which start at file offset base + pos.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = b''
+        self.base = fd.tell()
+        self.pos = 0
+
+    def Fill(self, n):
+        """Makes at least n bytes available at the cursor unless the file ends first."""
+        if self.pos + n > len(self.buf):
+            self.buf = self.buf[self.pos:] + self.fd.read(max(n, _READ_SIZE))
+            self.base += self.pos
+            self.pos = 0
+
+    def Find(self, sub, start):
+        """Returns the offset of the first occurrence of sub at or after start, or -1.
+
+        Reads through the file as needed, leaving the cursor somewhere after start.
+        """
+        self.seek(start)
+        while True:
+            i = self.buf.find(sub, self.pos)
+            if i >= 0:
+                return self.base + i
+            # Keep the end of the buffer in case sub spans it and the next read.
+            self.pos = max(self.pos, len(self.buf) - len(sub) + 1)
+            n = len(self.buf) - self.pos
+            self.Fill(n + 1)
+            if len(self.buf) - self.pos <= n:
+                return -1
+
+    def read(self, n):
+        self.Fill(n)
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.tell()
+            whence = 0
+        if whence == 0 and self.base <= offset <= self.base + len(self.buf):
+            # Keep the buffer if the offset is within it.
+            self.pos = offset - self.base
+        else:
+            self.fd.seek(offset, whence)
+            self.buf = b''
+            self.base = self.fd.tell()
+            self.pos = 0
+
+    def tell(self):
+        return self.base + self.pos
+
+    def close(self):
+        self.fd.close()
+
+class _MappedReader(object):
+    """Reads a file through an mmap of the whole file.
+
+    Has the same interface as _BufferedReader, with buf being the mmap and base always 0.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self.base = 0
+        self.pos = fd.tell()
+
+    def Fill(self, n):
+        """The whole file is mapped so there is nothing to read."""
+        pass
+
+    def Find(self, sub, start):
+        """Returns the offset of the first occurrence of sub at or after start, or -1."""
+        return self.buf.find(sub, start)
+
+    def read(self, n):
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.buf)
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.buf.close()
+        self.fd.close()
+
+def _DecodeMass(fd, edac, appends):
+    """Decodes the records of the mass at the current offset of fd, the dat file's reader.
+
+    Each measurement is passed to appends[dataType], which is None for unknown types. Returns
+    (magnetMass, acceleratingVoltage, channelTime, duration, end) where end is the offset just
+    past the mass, and leaves fd just past the last record decoded. Raises EOS if the scan
+    ends instead.
+    """
+    magnetMass = None
+    acceleratingVoltage = None
+    channelTime = None
+    debug = options.debug
+    # Decode the records directly from the reader's buffer, unpacking them a block at a
+    # time and doubling the block size until the end of the mass is found.
+    buf = fd.buf
+    pos = fd.pos
+    count = 32
+    try:
+        while True:
+            if pos + 4 > len(buf):
+                fd.pos = pos
+                fd.Fill(4)
+                buf = fd.buf
+                pos = fd.pos
+            for tmp in _UnpackWords(buf, pos, count):
+                pos += 4
+                key = (tmp & 0xF0000000) >> 28
+                if debug:
+                    Debug("Item at offset %d" % (fd.base + pos - 4))
+                    Debug("Key 0x%x" % key)
+                value = tmp & 0x0FFFFFFF
+                if key == KEY_EOS: # end of scan
+                    Debug("EOS")
+                    raise EOS()
+                elif key == KEY_EOM: # end of mass
+                    Debug("EOM")
+                    return magnetMass, acceleratingVoltage, channelTime, value, fd.base + pos
+                elif key == KEY_BSCAN:
+                    pass # not sure what to do with this
+                elif key == KEY_B:
+                    pass # not sure what to do with this either
+                elif key == KEY_VOLT:
+                    acceleratingVoltage = edac * 1000.0 / value / 2**18 # TODO: verify this formula
+                elif key == KEY_TIME:
+                    if channelTime is not None:
+                        raise Exception("channelTime is already set")
+                    channelTime = value
+                elif key == KEY_MASS:
+                    magnetMass = value * 1.0 / 2**18
+                elif key == KEY_DATA:
+                    append = appends[(value >> 20) & 0xF]
+                    if append is None:
+                        raise UnknownDataType(str((value >> 20) & 0xF))
+                    v = (value & 0xFFFF) << ((value >> 16) & 0xF)
+                    append(-v if value & 0x0F000000 else v)
+                else:
+                    raise UnknownKey(str(key))
+            count *= 2
+    finally:
+        # Leave the reader just past the last record decoded.
+        fd.pos = pos
 
 class Mass(object):
     """Class for one mass in a scan."""
     def __init__(self, scan, fd):
-        """Decodes the mass information from the scan at the specified file and offset"""
+        """Decodes the mass information from the scan at the current offset of fd.
+
+        fd is the dat file's reader, a _MappedReader or _BufferedReader.
+        """
         _CheckOpen(fd)
         self.fd = fd
         self.offset = self.fd.tell()
-        Debug("Getting mass at offset %d" % self.offset)
+        if options.debug:
+            Debug("Getting mass at offset %d" % self.offset)
         self.scan = scan
-        self.magnetMass = None
-        self.acceleratingVoltage = None
-        self.channelTime = None
-        self.duration = None
-        self.measurements = defaultdict(list)
-        while True:
-            Debug("Item at offset %d" % fd.tell())
-            tmp = struct.unpack("<I", fd.read(4))[0]
-            key = (tmp & 0xF0000000) >> 28
-            Debug("Key 0x%x" % key)
-            value = tmp & 0x0FFFFFFF
-            if key == KEY_EOS: # end of scan
-                Debug("EOS")
-                raise EOS()
-            elif key == KEY_EOM: # end of mass
-                Debug("EOM")
-                self._SetAttr('duration', value)
-                self.size = fd.tell() - self.offset
-                break
-            elif key == KEY_BSCAN:
-                pass # not sure what to do with this
-            elif key == KEY_B:
-                pass # not sure what to do with this either
-            elif key == KEY_VOLT:
-                value = scan.edac * 1000.0 / value / 2**18 # TODO: verify this formula
-                self.acceleratingVoltage = value  
-            elif key == KEY_TIME:
-                self._SetAttr('channelTime', value)
-            elif key == KEY_MASS:
-                self.magnetMass = value * 1.0 / 2**18
-            elif key == KEY_DATA:
-                flag = (value & 0x0F000000) >> 24
-                dataType = (value & 0x00F00000) >> 20
-                exp = (value & 0x000F0000) >> 16
-                value = value & 0x0000FFFF
-                if dataType == DATA_ANALOG:
-                    value = value << exp
-                    if flag != 0:
-                        value = -value
-                    self.measurements['analog'].append(value)
-                elif dataType == DATA_PULSE:
-                    value = value << exp
-                    if flag != 0:
-                        value = -value
-                    self.measurements['pulse'].append(value)
-                elif dataType == DATA_FARADAY:
-                    value = value << exp
-                    if flag != 0:
-                        value = -value
-                    self.measurements['faraday'].append(value)
-                else:
-                    raise UnknownDataType(str(dataType))
-            else:
-                raise UnknownKey(str(key))
-
-    def _SetAttr(self, name, value):
-        """Sets an attribute if it is not already set."""
-        if getattr(self, name) is not None:
-            raise Exception(name + " is already set")
-        else:
-            setattr(self, name, value)
+        # Collect the measurements in lists and convert them to arrays once the mass is done.
+        analog = []
+        pulse = []
+        faraday = []
+        # The append for each data type, indexed by the record's 4-bit data type field.
+        appends = [None] * 16
+        appends[DATA_ANALOG] = analog.append
+        appends[DATA_PULSE] = pulse.append
+        appends[DATA_FARADAY] = faraday.append
+        (self.magnetMass, self.acceleratingVoltage, self.channelTime,
+         self.duration, end) = _DecodeMass(fd, scan.edac, appends)
+        # Measurements fit in a signed 32-bit int (16-bit mantissa shifted by at most 15).
+        self.analog = array.array('i', analog)
+        self.pulse = array.array('i', pulse)
+        self.faraday = array.array('i', faraday)
+        self.measurements = {'analog': self.analog, 'pulse': self.pulse, 'faraday': self.faraday}
+        self.size = end - self.offset
 
 class Scan(object):
     """Class for one scan in a dat file."""
+    _header = struct.Struct("<47I")
+
     def __init__(self, dat, number):
         """Decodes the scan information at the current offset."""
-        Debug("Looking for scan header at offset %d" % dat.fd.tell())
-        self.headerSize = 47 * 4
+        if options.debug:
+            Debug("Looking for scan header at offset %d" % dat.fd.tell())
+        self.headerSize = self._header.size
         self.offset = dat.fd.tell()
-        vals = struct.unpack("<%dI" % (self.headerSize / 4), dat.fd.read(self.headerSize))
-        if list(vals[3:6]) != [0xd, 0xe, 0xf]:
+        # Parse the header in place in the reader's buffer rather than reading a copy of it.
+        fd = dat.fd
+        fd.Fill(self.headerSize)
+        buf = fd.buf
+        pos = fd.pos
+        if len(buf) - pos < self.headerSize:
+            raise EOFError("truncated scan header")
+        # Check the signature before unpacking the rest of the header.
+        start = pos + _SCAN_SIGNATURE_OFFSET
+        if buf[start:start + len(_SCAN_SIGNATURE)] != _SCAN_SIGNATURE:
             Debug("InvalidScanHeader")
             raise InvalidScanHeader
-        Debug("Scan Header")
-        for i, val in enumerate(vals):
-            Debug("%d %d: 0x%x %d" % (i, i*4, val, val))
+        vals = self._header.unpack_from(buf, pos)
+        fd.pos = pos + self.headerSize
+        if options.debug:
+            Debug("Scan Header")
+            for i, val in enumerate(vals):
+                Debug("%d %d: 0x%x %d" % (i, i*4, val, val))
         self.number = vals[SCAN_NUMBER]
         if self.number != number:
             Debug("scan number mismatch %d != %d" % (self.number, number))
@@ -217,7 +375,10 @@ class ScanIterator(object):
         _CheckOpen(scan.fd)
         self._scan = scan
 
-    def next(self):
+    def __iter__(self):
+        return self
+
+    def __next__(self):
         mass = self._scan.GetMass()
         if mass is None:
             raise StopIteration
@@ -225,6 +386,8 @@ class ScanIterator(object):
 
 class DatFile(object):
     """Class for one dat file."""
+    _header = struct.Struct("<%dI" % HDR_NUM_FIELDS)
+
     def __init__(self, path):
         self.path = path
         self.fd = None
@@ -232,12 +395,12 @@ class DatFile(object):
         Debug("Opening " + self.path)
         with open(self.path, 'rb') as fd:
             _Seek(fd, 0x10)
-            fields = HDR_NUM_FIELDS
-            tmp = fd.read(fields * 4)
-            vals = struct.unpack('<%dI' % fields, tmp)
+            tmp = fd.read(self._header.size)
+            vals = self._header.unpack(tmp)
             Debug("Header");
-            for i, val in enumerate(vals):
-                Debug("%d: 0x%x %d" % (i, val, val))
+            if options.debug:
+                for i, val in enumerate(vals):
+                    Debug("%d: 0x%x %d" % (i, val, val))
             self.timestamp = vals[HDR_TIMESTAMP]
             Debug("timestamp %d" % self.timestamp)
             self._indexLen = vals[HDR_INDEX_LEN]
@@ -249,11 +412,12 @@ class DatFile(object):
             Debug("end of header at offset %d" % self.endOfHeader)
             # Read the offsets although we don't use them, helpful for debugging.
             _Seek(fd, self._indexOffset + 4)
-            bytes = self._indexLen * 4
-            self._offsets = struct.unpack("<%dI" % self._indexLen, fd.read(bytes))
+            index = struct.Struct("<%dI" % self._indexLen)
+            self._offsets = index.unpack(fd.read(index.size))
             Debug("Offsets")
-            for i, offset in enumerate(self._offsets):
-                Debug("%d: %d" % (i, offset))
+            if options.debug:
+                for i, offset in enumerate(self._offsets):
+                    Debug("%d: %d" % (i, offset))
 
     def __iter__(self):
         """Enables iteration over the scans in a dat file."""
@@ -261,7 +425,12 @@ class DatFile(object):
 
     def Open(self):
         """Opens the dat file."""
-        self.fd = open(self.path, 'rb')
+        fd = open(self.path, 'rb')
+        try:
+            self.fd = _MappedReader(fd)
+        except (OSError, ValueError):
+            # mmap is not always possible (e.g. empty files), so fall back to buffered reads.
+            self.fd = _BufferedReader(fd)
         #skip over header
         self.fd.seek(self.endOfHeader)
 
@@ -280,7 +449,11 @@ class DatFile(object):
                 scan = Scan(self, index)
                 found = True
             except InvalidScanHeader:
-                _Seek(self.fd, offset+1, 0) # move forward 1 byte
+                # Skip to the next header signature after this offset.
+                start = self.fd.Find(_SCAN_SIGNATURE, offset + 1 + _SCAN_SIGNATURE_OFFSET)
+                if start < 0:
+                    return None
+                _Seek(self.fd, start - _SCAN_SIGNATURE_OFFSET)
             except:
                 return None
         return scan
@@ -291,7 +464,10 @@ class DatFileIterator(object):
         self._dat = dat
         self._index = 1
 
-    def next(self):
+    def __iter__(self):
+        return self
+
+    def __next__(self):
         scan = self._dat.GetScan(self._index)
         if scan is None:
             raise StopIteration
@@ -308,6 +484,86 @@ has the same base name as the first file with "combinedXX.csv" appended, where '
 number to avoid overwriting existing output files. If a directory is specified then all dat files 
 in the directory are processed.
 """
+def _WriteCSV(dat, outputfile, opts):
+    """Decodes a dat file and writes its contents to a CSV file.
+
+    The dat file must not be open. opts are the command line options, which are made global
+    so that they are also set in worker processes. Returns (outputfile, header) where header
+    is the line number of the column headers in the output file, or None if it has no headers.
+    """
+    global options
+    options = opts
+    headers = ["Scan", "Time", "ACF"]
+    header = None
+    with open(outputfile, "w", OUTPUT_BUFFER_SIZE, encoding=CSV_ENCODING) as output:
+        dat.Open()   # TODO: context
+        # Read elements from FIN2 file if it exists.
+        try:
+            name = os.path.splitext(dat.path)[0] + '.FIN2'
+            with open(name, 'rb') as fin2:
+                lines = fin2.read().splitlines()
+            # The elements are on the 8th line.
+            elements = lines[7].decode(CSV_ENCODING).strip().split(',')[1:]
+        except:
+            elements = None
+        if options.comments:
+            print(dat.path, dat.timestamp, datetime.datetime.fromtimestamp(dat.timestamp), file=output)
+
+        for i, scan in enumerate(dat):
+            timestamp = dat.timestamp + scan.time / 1000.0
+            results = [str(i+1), f'{timestamp:f}', f'{scan.acf:f}']
+            values = []
+            valueHeaders = []
+            faraday = False
+            
+            try:
+                for j, mass in enumerate(scan):
+                    measurements = mass.measurements
+                    modes = ['pulse', 'analog']
+                    if options.debug:
+                        Debug("scan %d mass %d pulse %d analog %d faraday %d" % (i, j, 
+                              len(mass.pulse), len(mass.analog), len(mass.faraday)))
+                    if len(mass.faraday) > 0:
+                        modes.append('faraday')
+                        faraday = True
+                    if headers is not None:
+                        # Only needed until the headers have been written.
+                        element = f"Mass{j+1:02d}" if elements is None else elements[j]
+                        for t in modes:
+                            valueHeaders += [f"{element}{t[0]}"] * len(measurements[t])
+                        valueHeaders.append('')
+                    for t in modes:
+                        # Negative values are written as their magnitude followed by '*'.
+                        values += [str(-x) + '*' if x < 0 else str(x) for x in measurements[t]]
+                    values.append('')
+                if faraday:
+                    if headers is not None:
+                        headers.append('FCF')
+                    results.append(f'{scan.fcf:f}')
+
+            except UnknownDataType as e:
+                print(f"Warning: unknown data type 0x{int(e.args[0]):x}", file=sys.stderr)
+                continue
+            except UnknownKey as e:
+                print(f"Warning: unknown key 0x{int(e.args[0]):x}", file=sys.stderr)
+                continue
+            if headers is not None:
+                header = 1 if options.comments else 0
+                output.write(",".join(headers + valueHeaders) + "\n")
+                headers = None
+            output.write(",".join(results + values) + "\n")
+        dat.Close()
+    return outputfile, header
+
+def _AppendCSV(output, path, skip=None):
+    """Appends the contents of a CSV file to output, leaving out line number skip if given."""
+    with open(path, "r", encoding=CSV_ENCODING) as f:
+        if skip is not None:
+            for i in range(0, skip):
+                output.write(f.readline())
+            f.readline()
+        shutil.copyfileobj(f, output, OUTPUT_BUFFER_SIZE)
+
 def main(args):
     """Stand-alone application"""
     global options
@@ -376,81 +632,50 @@ def main(args):
                 break
             i += 1
         try:
-            combinedOutput = open(path, "w")
-            print "Writing to", path
+            combinedOutput = open(path, "w", OUTPUT_BUFFER_SIZE, encoding=CSV_ENCODING)
+            print("Writing to", path)
         except:
             combinedOutput = None
 
-    first = True
-    for dat in dats:
-        headers = ["Scan", "Time", "ACF"]
-        outputfile = os.path.splitext(dat.path)[0] + '.csv'
-        with open(outputfile, "w") as output:
-            print "Writing to", outputfile
-            dat.Open()   # TODO: context
-            # Read elements from FIN2 file if it exists.
-            try:
-                name = os.path.splitext(dat.path)[0] + '.FIN2'
-                with open(name, 'rb') as fin2:
-                    for i in xrange(0, 8):
-                        line = fin2.readline().strip()
-                    elements = line.split(',')[1:]
-            except:
-                elements = None
-            if options.comments:
-                print >> output, dat.path, dat.timestamp, datetime.datetime.fromtimestamp(dat.timestamp)
-                if combinedOutput != None:
-                    print >> combinedOutput, dat.path, dat.timestamp, datetime.datetime.fromtimestamp(dat.timestamp)
-
-            for i, scan in enumerate(dat):
-                timestamp = dat.timestamp + scan.time / 1000.0
-                results = [str(i+1), '%f' % timestamp, '%f' % scan.acf]
-                values = []
-                valueHeaders = []
-                faraday = False
-                
-                try:
-                    for j, mass in enumerate(scan):
-                        modes = ['pulse', 'analog']
-                        Debug("scan %d mass %d pulse %d analog %d faraday %d" % (i, j, 
-                              len(mass.measurements['pulse']), 
-                              len(mass.measurements['analog']), 
-                              len(mass.measurements['faraday'])))
-                        if len(mass.measurements['faraday']) > 0:
-                            modes.append('faraday')
-                            faraday = True
-                        if headers is not None:
-                            element = "Mass%02d" % (j+1) if elements is None else elements[j]
-                            if headers is not None:
-                                for t in modes:
-                                    valueHeaders += ["%s%s" % (element, t[0])] * len(mass.measurements[t])
-                                valueHeaders.append('')
-                        for t in modes:
-                            values += map(lambda x: str(x) if not str(x).startswith('-') else str(-x)+'*', mass.measurements[t])
-                        values.append('')
-                    if faraday:
-                        if headers is not None:
-                            headers.append('FCF')
-                        results.append('%f' % scan.fcf)
-
-                except UnknownDataType, e:
-                    print >> sys.stderr, "Warning: unknown data type 0x%x" % int(e.message)
-                    continue
-                except UnknownKey, e:
-                    print >> sys.stderr, "Warning: unknown key 0x%x" % int(e.message)
-                    continue
-                if headers is not None:
-                    msg = ",".join(headers + valueHeaders)
-                    print >> output, msg
-                    if combinedOutput != None and first:
-                        print >> combinedOutput, msg
-                    headers = None
-                msg = ",".join(results + values)
-                print >> output, msg
-                if combinedOutput != None:
-                    print >> combinedOutput, msg
-            dat.Close()
+    outputfiles = [os.path.splitext(dat.path)[0] + '.csv' for dat in dats]
+    for outputfile in outputfiles:
+        print("Writing to", outputfile)
+    # A file can be given more than once (e.g. a directory and a file in it). Decode each
+    # file only once, so that no two workers write the same output file, but still append it
+    # to the combined output each time it was given.
+    keys = [os.path.normcase(os.path.abspath(outputfile)) for outputfile in outputfiles]
+    jobs = []
+    for i, key in enumerate(keys):
+        if key not in keys[:i]:
+            jobs.append(i)
+    jobDats = [dats[i] for i in jobs]
+    jobOutputfiles = [outputfiles[i] for i in jobs]
+    opts = [options] * len(jobs)
+    executor = None
+    if len(jobs) > 1 and not options.debug:
+        # The dat files are independent so decode them in parallel. map returns the results
+        # in order so the combined output is in the same order as before. Debugging output
+        # would be interleaved, so in that case they are done one at a time.
+        executor = ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1))
+        results = executor.map(_WriteCSV, jobDats, jobOutputfiles, opts)
+    else:
+        results = map(_WriteCSV, jobDats, jobOutputfiles, opts)
+    try:
+        first = True
+        done = {}
+        for key in keys:
+            if key not in done:
+                done[key] = next(results)
+            outputfile, header = done[key]
+            if combinedOutput != None:
+                # Only the first file's headers go in the combined output.
+                _AppendCSV(combinedOutput, outputfile, None if first else header)
             first = False
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if combinedOutput != None:
+        combinedOutput.close()
 
 if __name__ == '__main__':
     main(sys.argv)